@@ -4,19 +4,73 @@ import argparse
 import csv
 import random
 
+_SAFE_RESPONSE_TRANS = str.maketrans({" ": "_", "'": "_", ",": "_"})
+_RESERVED_RESPONSES = frozenset(("conversation_start", "anything_else"))
+_SKILL_HEAD = dict(
+    entities=[],
+    metadata=dict(
+        api_version=dict(
+            major_version="v2",
+            minor_version="2018-11-08"
+        ),
+    ),
+    webhooks=[dict(
+        url="",
+        name="main_webhook",
+        headers=[]
+    )]
+)
+_SKILL_TAIL = dict(
+    counterexamples=[],
+    system_settings=dict(
+        off_topic=dict(
+            enabled=False
+        ),
+        disambiguation=dict(
+            prompt="Did you mean:",
+            enabled=True,
+            randomize=True,
+            max_suggestions=5,
+            suggestion_text_policy="user_label",
+            none_of_the_above_prompt="None of the above."
+        ),
+        system_entities=dict(
+            enabled=True
+        ),
+        human_agent_assist=dict(
+            prompt="Did you mean:"
+        ),
+        intent_classification=dict(
+            training_backend_version="v2"
+        ),
+        spelling_auto_correct=True
+    ),
+    learning_opt_out=False,
+    name="Scripted Dialog",
+    language="en",
+    description=""
+)
+
+
 class Intent:
+    __slots__ = ("id", "examples", "_encoded")
+
     def __init__(self, id, *examples):
         self.id = id
         self.examples = examples
+        self._encoded = None
     
     def encode(self):
-        encoded = dict(
-            intent=self.id,
-            examples=[dict(text=example) for example in self.examples]
-        )
-        return encoded
+        if self._encoded is None:
+            self._encoded = {
+                "intent": self.id,
+                "examples": [{"text": example} for example in self.examples]
+            }
+        return self._encoded
 
 class StoryNodePointer:
+    __slots__ = ("source", "target", "conditions", "previous_sibling", "id")
+
     def __init__(self, source, target, condition, previous_sibling):
         self.source = source
         self.target = target
@@ -25,49 +79,51 @@ class StoryNodePointer:
         self.id = self.source.id + "-" + self.target.id + "-" + str(random.randint(1, 10000))
     
     def encode(self):
-        node = dict(
-            type="standard",
-            title=self.target.id,
-            parent=self.source.id,
-            next_step=dict(
-                behavior="jump_to",
-                selector="condition",
-                dialog_node=self.target.id
-            ),
-            context=dict(),
-            dialog_node=self.id,
-            conditions=self.conditions
-        )
+        node = {
+            "type": "standard",
+            "title": self.target.id,
+            "parent": self.source.id,
+            "next_step": {
+                "behavior": "jump_to",
+                "selector": "condition",
+                "dialog_node": self.target.id
+            },
+            "context": {},
+            "dialog_node": self.id,
+            "conditions": self.conditions
+        }
         if self.previous_sibling is not None:
             node["previous_sibling"] = self.previous_sibling.id
         return node
 
 class StoryNode:
+    __slots__ = ("id", "text", "children", "parent", "previous_sibling", "conditions")
+
     def __init__(self, id, text, responses, children):
         self.id = id
         self.text = text
-        self.children = {response : child for response, child in zip(responses, children)}
+        self.children = dict(zip(responses, children))
         self.parent = None
         self.previous_sibling = None
         self.conditions = None
 
     def encode(self):
         text = self.text.replace("\n", " ").replace(":", "-").replace("\"", "\'").replace(",", " ")
-        node = dict(
-            type="standard",
-            title=self.id,
-            output=dict(
-                generic=[dict(
-                    values=[dict(
-                        text=f'<speak>{text}</speak>'
-                    )],
-                    response_type="text",
-                    selection_policy="sequential"
-                )]
-            ),
-            context=dict(),
-            dialog_node=self.id
-        )
+        node = {
+            "type": "standard",
+            "title": self.id,
+            "output": {
+                "generic": [{
+                    "values": [{
+                        "text": f'<speak>{text}</speak>'
+                    }],
+                    "response_type": "text",
+                    "selection_policy": "sequential"
+                }]
+            },
+            "context": {},
+            "dialog_node": self.id
+        }
         if self.parent is not None:
             node["parent"] = self.parent.id
         if self.previous_sibling is not None:
@@ -79,28 +135,37 @@ class StoryNode:
 
     def tree(self, story_nodes):
         nodes = [self]
-        previous_sibling = None
-        for response in self.children.keys():
-            is_pointer = False
-            child = story_nodes[self.children[response]]
-            if child.parent is None:
-                child.parent = story_nodes[self.id]
-            else:
-                child = StoryNodePointer(self, child, response, previous_sibling)
-                is_pointer = True
-            if previous_sibling is not None:
-                child.previous_sibling = previous_sibling
-            previous_sibling = child
-            child.conditions = response
-            if not is_pointer:
-                nodes += child.tree(story_nodes)
+        append = nodes.append
+        stack = [[self, iter(self.children.items()), None]]
+        push = stack.append
+        while stack:
+            frame = stack[-1]
+            node, children, previous_sibling = frame
+            for response, child_id in children:
+                is_pointer = False
+                child = story_nodes[child_id]
+                if child.parent is None:
+                    child.parent = node
+                else:
+                    child = StoryNodePointer(node, child, response, previous_sibling)
+                    is_pointer = True
+                if previous_sibling is not None:
+                    child.previous_sibling = previous_sibling
+                previous_sibling = child
+                child.conditions = response
+                append(child)
+                if not is_pointer:
+                    frame[2] = previous_sibling
+                    push([child, iter(child.children.items()), None])
+                    break
             else:
-                nodes += [child]
+                stack.pop()
         return nodes
 
 class StoryTree:
     def __init__(self, filename=None):
         self.nodes = []
+        self.voices = {}
         if filename is not None:
             self.load_from_csv(filename)
     
@@ -109,18 +174,14 @@ class StoryTree:
     
     def load_from_csv(self, filename):
         self.nodes = []
-        with open(filename, "r") as f:
-            reader = csv.reader(f)
-            for line in reader:
-                line = list(filter(lambda field : field != "", line))
-                id, text, = line[0], line[1]
-                node = StoryNode(id, text, [], [])
-                num_responses = (len(line) - 2) // 2
-                if num_responses > 0:
-                    behaviour = line[2:]
-                for response, child in zip(behaviour[:num_responses], behaviour[num_responses:]):
-                    node.children[response] = child
-                self.nodes += [node]
+        append = self.nodes.append
+        with open(filename, "r", newline="") as f:
+            for line in csv.reader(f):
+                line = [field for field in line if field]
+                id, text, behaviour = line[0], line[1], line[2:]
+                num_responses = len(behaviour) // 2
+                node = StoryNode(id, text, behaviour[:num_responses], behaviour[num_responses:])
+                append(node)
     
     def load_from_console(self):
         id = input("Node ID: ")
@@ -141,89 +202,52 @@ class StoryTree:
                 name, voice_name = line[:-1].split(",")
                 self.voices[name] = voice_name
     
-    def export(self):
-        responses = []
-        for node in self.nodes:
-            if len(node.children) > 0:
-                node.text += "\nDo you: \n"
-            for response in node.children.keys():
-                responses += [response]
-                node.text += response + "?\n"
-        responses = list(set(responses)) + ["prompt continue", "first start", "no"]
+    def encode(self):
         intents = []
         intent_to_node_id = {}
         response_to_intent = {}
-        for i in range(len(responses)):
-            if responses[i] not in ["conversation_start", "anything_else"]:
-                safe_response = responses[i].replace(" ", "_").replace("'", "_").replace(",", "_").lower()
-                intent = Intent(safe_response, responses[i])
-                intents += [intent.encode()]
-                response_to_intent[responses[i]] = "#" + safe_response
+        def add_intent(response):
+            if response not in response_to_intent:
+                safe_response = response.translate(_SAFE_RESPONSE_TRANS).lower()
+                intents.append(Intent(safe_response, response).encode())
+                response_to_intent[response] = "#" + safe_response
+            return response_to_intent[response]
+        nodes = {}
         for node in self.nodes:
-            new_responses = {}
-            for response, child in node.children.items():
-                if response not in ["conversation_start", "anything_else"]:
-                    new_responses[response_to_intent[response]] = child
-                    intent_to_node_id[response_to_intent[response]] = child
-                else:
-                    new_responses[response] = child
-            node.children = new_responses
-            for name, voice_name in self.voices.items():
-                pattern = f'\[{name}\](?:\s*)((?:\\")+[^\\"]*(?:\\")+)'
-                node.text = re.sub(pattern, f'<voice name=\'{voice_name}\'>\\1</voice>', node.text)
-        nodes = {node.id : node for node in self.nodes}
-        first_node = list(nodes.keys())[0]
+            nodes[node.id] = node
+            children = node.children
+            if len(children) > 0:
+                text = [node.text, "\nDo you: \n"]
+                for response in list(children):
+                    text.extend((response, "?\n"))
+                    child = children.pop(response)
+                    if response not in _RESERVED_RESPONSES:
+                        response = add_intent(response)
+                        intent_to_node_id[response] = child
+                    children[response] = child
+                node.text = "".join(text)
+        for response in ["prompt continue", "first start", "no"]:
+            add_intent(response)
+        voice_patterns = [(re.compile(r'\[' + re.escape(name) + r'\]\s*("+[^"\n]*"+)'), f'<voice name=\'{voice_name}\'>\\1</voice>') for name, voice_name in self.voices.items()]
+        for pattern, replacement in voice_patterns:
+            sub = pattern.sub
+            for node in self.nodes:
+                node.text = sub(replacement, node.text)
+        first_node = self.nodes[0].id
         nodes["load_state"] = StoryNode("load_state", "Would you like to continue from where you left off?", ["#yes", "#no"], ["continue_from_point", "1"])
         nodes["continue_from_point"] = StoryNode("continue_from_point", "Please enter the last phrase used", list(intent_to_node_id.keys()), list(intent_to_node_id.values()))
         nodes["start"] = StoryNode("start", "Start node", ["#prompt_continue", "#first_start"], ["load_state", first_node])
         tree = nodes["start"].tree(nodes)
         tree[0].conditions = "conversation_start"
         dialog_nodes = [node.encode() for node in tree]
-        encoded = dict(
-            intents=intents,
-            entities=[],
-            metadata=dict(
-                api_version=dict(
-                    major_version="v2",
-                    minor_version="2018-11-08"
-                ),
-            ),
-            webhooks=[dict(
-                url="",
-                name="main_webhook",
-                headers=[]
-            )],
-            dialog_nodes=dialog_nodes,
-            counterexamples=[],
-            system_settings=dict(
-                off_topic=dict(
-                    enabled=False
-                ),
-                disambiguation=dict(
-                    prompt="Did you mean:",
-                    enabled=True,
-                    randomize=True,
-                    max_suggestions=5,
-                    suggestion_text_policy="user_label",
-                    none_of_the_above_prompt="None of the above."
-                ),
-                system_entities=dict(
-                    enabled=True
-                ),
-                human_agent_assist=dict(
-                    prompt="Did you mean:"
-                ),
-                intent_classification=dict(
-                    training_backend_version="v2"
-                ),
-                spelling_auto_correct=True
-            ),
-            learning_opt_out=False,
-            name="Scripted Dialog",
-            language="en",
-            description=""
-        )
-        return json.dumps(encoded)
+        encoded = {"intents": intents, **_SKILL_HEAD, "dialog_nodes": dialog_nodes, **_SKILL_TAIL}
+        return encoded
+
+    def export(self):
+        return json.dumps(self.encode())
+
+    def export_to(self, f):
+        json.dump(self.encode(), f, separators=(",", ":"))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Utility for converting dialogue scripts into IBM Watson Dialog Skills.")
@@ -235,5 +259,5 @@ if __name__ == "__main__":
     if args.voice_file is not None:
         tree.load_voice_file(args.voice_file)
     with open(args.output, "w+", encoding="utf-8") as f:
-        f.write(tree.export())
+        tree.export_to(f)
     print(f"Completed, output saved in {args.output}.")
\ No newline at end of file